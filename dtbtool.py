@@ -20,11 +20,13 @@ Add chips index
 Append dtb images
 """
 
-from argparse import ArgumentParser, FileType
+from argparse import ArgumentParser
 from struct import pack
+import hashlib
 import os
 import re
 import subprocess
+import sys
 
 QCDT_MAGIC = "QCDT"    # Master DTB magic
 QCDT_VERSION = 3       # QCDT version
@@ -37,6 +39,8 @@ QCDT_PMIC_TAG = "qcom,pmic-id = <"
 PAGE_SIZE_DEF = 2048
 PAGE_SIZE_MAX = 1024 * 1024
 
+FINGERPRINT_EXT = ".fingerprint"
+
 _dt_version = 1
 _dtb_list = []
 _chip_list = []
@@ -225,24 +229,38 @@ def chip_add(chip):
     _chip_list.append(chip)
     return True
 
-def find_dtb(path, args):
-    """Search for dtbs in the provided folder and subfolders and returns count(chips)"""
-    dtb_count = 0
+def list_dtb(path, args):
+    """Search for dtbs in the provided folder and subfolders and returns their paths"""
+    dtb_paths = []
 
-    for entry in os.listdir(path):
+    entries = os.listdir(path)
+    if args.deterministic:
+        # Don't depend on the filesystem ordering
+        entries.sort()
+
+    for entry in entries:
         entry_path = os.path.join(path, entry)
         if os.path.isdir(entry_path):
             print("Searching subdir: %s ..." % entry_path)
-            dtb_count += find_dtb(entry_path, args)
+            dtb_paths += list_dtb(entry_path, args)
         else:
             ext = os.path.splitext(entry)
             if ext[1] == ".dtb":
-                print("Found file: %s ..." % entry)
-                dtb_count += process_dtb(entry_path, entry, args)
+                dtb_paths.append(entry_path)
+
+    return dtb_paths
+
+def find_dtb(dtb_paths, args):
+    """Processes the provided dtbs and returns count(chips)"""
+    dtb_count = 0
+
+    for entry_path in dtb_paths:
+        print("Found file: %s ..." % os.path.basename(entry_path))
+        dtb_count += process_dtb(entry_path, args)
 
     return dtb_count
 
-def process_dtb(entry_path, filename, args):
+def process_dtb(entry_path, args):
     """Collects chips infos in a sigle dtb and returns count(chips)"""
     global _dt_version
     global _dtb_list
@@ -259,22 +277,22 @@ def process_dtb(entry_path, filename, args):
     if msmversion == 1:
         if not chiplist:
             print("skip, failed to scan for %s tag" % args.dt_tag)
-            return
+            return 0
     if msmversion == 2:
         if not chiplist:
             print("skip, failed to scan for %s or %s tag" % (args.dt_tag, QCDT_BOARD_TAG))
-            return
+            return 0
     if msmversion == 3:
         if not chiplist:
             print("skip, failed to scan for %s, %s or %s tag" %
                   (args.dt_tag, QCDT_BOARD_TAG, QCDT_PMIC_TAG))
-            return
+            return 0
 
     # Retrieve dtb size
     size = os.stat(entry_path).st_size
     if size == 0:
         print("skip, failed to get DTB size")
-        return
+        return 0
 
     # Calculate dtb padded size
     dtb_size = size + (args.page_size - (size % args.page_size))
@@ -289,12 +307,12 @@ def process_dtb(entry_path, filename, args):
                chip.pmic_model0, chip.pmic_model1, chip.pmic_model2, chip.pmic_model3))
 
         # Add a reference to the DTB
-        chip.dtb_file = filename
+        chip.dtb_file = entry_path
 
         rc = chip_add(chip)
         if not rc:
             print("... duplicate info, skipped")
-            return
+            continue
 
         dtb_count += 1
 
@@ -306,8 +324,8 @@ def parse_cmdline():
         description="dtbTool version " + str(QCDT_VERSION))
     parser.add_argument("input_dir",
                         help="Input directory")
-    parser.add_argument("-o", "--output-file", type=FileType('wb'), required=True,
-                        help="Output file")
+    parser.add_argument("-o", "--output-file", dest="output_path", required=True,
+                        help="Output file, '-' for stdout")
     parser.add_argument("-p", "--dtc-path", default="",
                         help="path to dtc")
     parser.add_argument("-s", "--page-size", default=PAGE_SIZE_DEF, type=int,
@@ -318,6 +336,8 @@ def parse_cmdline():
                         help="output dtb v2 format")
     parser.add_argument("-3", "--force-v3", action="store_true",
                         help="output dtb v3 format")
+    parser.add_argument("--deterministic", action="store_true",
+                        help="reproducible output, skipped if inputs are unchanged")
     return parser.parse_args()
 
 def validate_args(args):
@@ -328,6 +348,25 @@ def validate_args(args):
     if args.force_v2 and args.force_v3:
         raise ValueError("A version output argument may only be passed once")
 
+    if args.output_path == "-":
+        if args.deterministic:
+            raise ValueError("Deterministic mode needs an output file, not stdout")
+        return
+
+    output_dir = os.path.dirname(os.path.abspath(args.output_path))
+    if os.path.exists(args.output_path):
+        writable = not os.path.isdir(args.output_path) and \
+                   os.access(args.output_path, os.W_OK)
+    else:
+        writable = os.access(output_dir, os.W_OK)
+
+    # The fingerprint is stored next to the output
+    if args.deterministic and not os.access(output_dir, os.W_OK):
+        writable = False
+
+    if not writable:
+        raise ValueError("Output file is not writable: %s" % args.output_path)
+
 def override_dt_version(args, dt_version):
     """Overrides dt version if requested"""
     if args.force_v2:
@@ -337,6 +376,61 @@ def override_dt_version(args, dt_version):
     else:
         return dt_version
 
+def path_to_bytes(path):
+    """Returns the raw bytes of a path, as stored on the filesystem"""
+    if isinstance(path, bytes):
+        # Python 2 str
+        return path
+    return os.fsencode(path)
+
+def get_file_hash(path):
+    """Returns the sha256 hex digest of a file"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as blob:
+        for chunk in iter(lambda: blob.read(65536), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def get_fingerprint(args, dtb_paths):
+    """Returns a fingerprint of the options, dtb paths and dtb contents"""
+    sha = hashlib.sha256()
+
+    options = (QCDT_VERSION, args.dtc_path, args.page_size, args.dt_tag,
+               args.force_v2, args.force_v3)
+    sha.update(repr(options).encode())
+
+    for entry_path in dtb_paths:
+        # Use the same separator everywhere
+        rel_path = os.path.relpath(entry_path, args.input_dir).replace(os.sep, "/")
+        sha.update(path_to_bytes(rel_path) + b"\0")
+        sha.update(get_file_hash(entry_path).encode())
+
+    return sha.hexdigest()
+
+def is_output_up_to_date(args, fingerprint):
+    """Checks whether the existing output was generated from the same inputs"""
+    fingerprint_path = args.output_path + FINGERPRINT_EXT
+
+    if not os.path.isfile(args.output_path) or not os.path.isfile(fingerprint_path):
+        return False
+
+    with open(fingerprint_path, "r") as fpfile:
+        data = fpfile.read().split()
+
+    # Output must not have been modified after it was generated
+    return data == [fingerprint, get_file_hash(args.output_path)]
+
+def write_fingerprint(args, fingerprint):
+    """Stores the fingerprint of the inputs along with the output hash"""
+    with open(args.output_path + FINGERPRINT_EXT, "w") as fpfile:
+        fpfile.write("%s %s\n" % (fingerprint, get_file_hash(args.output_path)))
+
+def remove_fingerprint(args):
+    """Removes the fingerprint of a previous run, if any"""
+    fingerprint_path = args.output_path + FINGERPRINT_EXT
+    if os.path.isfile(fingerprint_path):
+        os.remove(fingerprint_path)
+
 def get_entry_size(dt_version):
     """Returns the entry size according to the dt version"""
     if dt_version == 1:
@@ -370,32 +464,32 @@ def get_entry_size(dt_version):
 # | dtb size        |
 # +-----------------+
 #
-def write_index_table(args, chip_list, dt_version, next_dtb_offset):
+def write_index_table(out, chip_list, dt_version, next_dtb_offset):
     """For each chip write its index table"""
     global _dtb_list
     dtb_ordered_list = []
 
     for chip in chip_list:
-        args.output_file.write(pack('I', chip.chipset))
-        args.output_file.write(pack('I', chip.platform))
+        out.write(pack('I', chip.chipset))
+        out.write(pack('I', chip.platform))
 
         if dt_version >= 2:
-            args.output_file.write(pack('I', chip.subtype))
+            out.write(pack('I', chip.subtype))
 
-        args.output_file.write(pack('I', chip.rev_num))
+        out.write(pack('I', chip.rev_num))
 
         if dt_version >= 3:
-            args.output_file.write(pack('4I',
-                                        chip.pmic_model0,
-                                        chip.pmic_model1,
-                                        chip.pmic_model2,
-                                        chip.pmic_model3))
+            out.write(pack('4I',
+                           chip.pmic_model0,
+                           chip.pmic_model1,
+                           chip.pmic_model2,
+                           chip.pmic_model3))
 
         # Search linked dtb in the indexed dtb list (only write a single dtb once)
-        indexed_dtb = next((item for item in dtb_ordered_list if chip.dtb_file in item.path), None)
+        indexed_dtb = next((item for item in dtb_ordered_list if item.path == chip.dtb_file), None)
         if not indexed_dtb:
             # Not found, search in dtb list
-            dtb = next((item for item in _dtb_list if chip.dtb_file in item.path), None)
+            dtb = next((item for item in _dtb_list if item.path == chip.dtb_file), None)
             if not dtb:
                 # Not found, kinda impossible, where did this chip came from?
                 raise ValueError("DTB not found")
@@ -404,8 +498,8 @@ def write_index_table(args, chip_list, dt_version, next_dtb_offset):
             dtb.offset = next_dtb_offset
 
             # Write linked dtb data
-            args.output_file.write(pack('I', dtb.offset))
-            args.output_file.write(pack('I', dtb.size))
+            out.write(pack('I', dtb.offset))
+            out.write(pack('I', dtb.size))
 
             # Update offset for the next dtb
             next_dtb_offset += dtb.size
@@ -414,13 +508,13 @@ def write_index_table(args, chip_list, dt_version, next_dtb_offset):
             dtb_ordered_list.append(dtb)
         else:
             # Found, point to previously indexed dtb
-            args.output_file.write(pack('I', indexed_dtb.offset))
-            args.output_file.write(pack('I', indexed_dtb.size))
+            out.write(pack('I', indexed_dtb.offset))
+            out.write(pack('I', indexed_dtb.size))
 
     return dtb_ordered_list
 
 
-def write_dtb_data(args, dtb_ordered_list):
+def write_dtb_data(args, out, dtb_ordered_list):
     """Write dtb data"""
     for dtb in dtb_ordered_list:
         # Read DTB
@@ -428,7 +522,7 @@ def write_dtb_data(args, dtb_ordered_list):
             content = dtblob.read()
 
         # Append DTB content
-        args.output_file.write(content)
+        out.write(content)
 
         # Calculate padding
         padding = args.page_size - (len(content) % args.page_size)
@@ -439,14 +533,14 @@ def write_dtb_data(args, dtb_ordered_list):
             raise ValueError("DTB size mismatch, please re-run: expected %d vs actual %d (%s)" %
                              (dtb.size, size, dtb.path))
         # Write padding
-        write_padding(args, padding)
+        write_padding(out, padding)
 
-def write_padding(args, padding):
+def write_padding(out, padding):
     """Write variable length for next DTB to start on page boundary"""
     if padding > 0:
-        args.output_file.write(pack('%dx' % padding))
+        out.write(pack('%dx' % padding))
 
-def write_data(args, dtb_count):
+def write_data(args, out, dtb_count):
     """Write header + chip index table + dtb with relative paddings"""
     global _chip_list
     global _dt_version
@@ -468,29 +562,36 @@ def write_data(args, dtb_count):
     print(" Writing header...")
 
     # Write the header
-    args.output_file.write(pack('4s', QCDT_MAGIC.encode()))
-    args.output_file.write(pack('I', dt_version))
-    args.output_file.write(pack('I', dtb_count))
+    out.write(pack('4s', QCDT_MAGIC.encode()))
+    out.write(pack('I', dt_version))
+    out.write(pack('I', dtb_count))
 
     # Order chip list by chipset -> platform -> subtype -> rev_num
-    chip_list = sorted(_chip_list, key=lambda item:
-                       (item.chipset, item.platform, item.subtype, item.rev_num))
+    if args.deterministic:
+        # Break ties on the pmic models too, chips are unique on all fields
+        chip_list = sorted(_chip_list, key=lambda item:
+                           (item.chipset, item.platform, item.subtype, item.rev_num,
+                            item.pmic_model0, item.pmic_model1, item.pmic_model2,
+                            item.pmic_model3))
+    else:
+        chip_list = sorted(_chip_list, key=lambda item:
+                           (item.chipset, item.platform, item.subtype, item.rev_num))
 
     print(" Writing chip index table...")
 
     # Write chip index table
-    dtb_ordered_list = write_index_table(args, chip_list, dt_version, dtb_offset)
+    dtb_ordered_list = write_index_table(out, chip_list, dt_version, dtb_offset)
 
     # end of table indicator
-    args.output_file.write(pack('I', 0))
+    out.write(pack('I', 0))
 
     print(" Appending DTB images...")
 
     # Write padding for the first DTB
-    write_padding(args, padding)
+    write_padding(out, padding)
 
     # Write DTBs
-    write_dtb_data(args, dtb_ordered_list)
+    write_dtb_data(args, out, dtb_ordered_list)
 
 #
 # Extract 'qcom,msm-id' 'qcom,board-id' parameter from DTB
@@ -512,18 +613,43 @@ def main():
     print("DTB combiner:")
 
     print("  Input directory: %s" % args.input_dir)
-    print("  Output file: %s" % os.path.realpath(args.output_file.name))
+    if args.output_path == "-":
+        print("  Output file: <stdout>")
+    else:
+        print("  Output file: %s" % os.path.realpath(args.output_path))
 
-    dtb_count = find_dtb(args.input_dir, args)
+    dtb_paths = list_dtb(args.input_dir, args)
+
+    fingerprint = None
+    if args.deterministic:
+        fingerprint = get_fingerprint(args, dtb_paths)
+        print("  Fingerprint: %s" % fingerprint)
+
+        if is_output_up_to_date(args, fingerprint):
+            print("=> Output is up to date, skipped")
+            return
+
+    dtb_count = find_dtb(dtb_paths, args)
 
     print("=> Found %d unique DTB(s)" % dtb_count)
 
-    if dtb_count is None or dtb_count == 0:
+    if dtb_count == 0:
+        # Don't leave a stale image behind
+        if args.output_path != "-":
+            open(args.output_path, "wb").close()
+            remove_fingerprint(args)
         return
 
     print("Generating master DTB... ")
 
-    write_data(args, dtb_count)
+    if args.output_path == "-":
+        write_data(args, getattr(sys.stdout, "buffer", sys.stdout), dtb_count)
+    else:
+        with open(args.output_path, "wb") as out:
+            write_data(args, out, dtb_count)
+
+    if fingerprint:
+        write_fingerprint(args, fingerprint)
 
     print("Done")
 